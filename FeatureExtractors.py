@@ -1,5 +1,8 @@
 from CMUTweetTagger import runtagger_parse
+import sys
 import re
+import datetime
+from bisect import bisect_left
 from collections import defaultdict
 import numpy as np
 import csv
@@ -18,6 +21,10 @@ class FeatureExtractor():
         self.groupby = "Day"
         self.features = []
         self.normalize = False
+        self.dtype = float
+        self.daily = None
+        # False for features that do not depend on the time window
+        self.windowed = True
     def header(self):
         return self.heading
     def doFeatures(self, conversation):
@@ -26,47 +33,213 @@ class FeatureExtractor():
     def doUtteranceFeatures(self, utterance): 
         return []
 
-    def groupFeatures(self, utterances): 
+    def startChunks(self): 
+        """
+        Begin a conversation that is processed in chunks (see
+        Conversation.processChunks) instead of all at once. 
+        """
+        self.daily = defaultdict(dict)
+
+    def doChunk(self, chunk): 
+        """
+        Reduce the utterances of chunk, a Conversation holding the next
+        time-ordered slice of utterances, into mergeable aggregates. The
+        per-utterance features are not kept. 
+        """
+        self.doFeatures(chunk)
+        self.addDaily(self.daily, chunk.utterances)
+        self.features = []
+
+    def finishChunks(self, conversation): 
+        self.normalizeDaily(self.daily)
+
+    def featureLayout(self, utterances):
+        """
+        Return the column headings that groupFeatures will produce for
+        utterances, without computing any of the values. utterances is None
+        for a conversation that was processed in chunks. 
+        """
+        if self.groupby == "Day": 
+            if utterances is None: 
+                people = sorted(self.daily)
+            else: 
+                people = sorted(set([x.speaker for x in utterances]))
+
+            headings = []
+            for person in people:
+                headings += ["{}_{}_Mean".format(person, feature_name) for feature_name in self.header()]
+                headings += ["{}_{}_Variance".format(person, feature_name) for feature_name in self.header()]
+            return headings
+        elif self.groupby == "Conversation": 
+            return list(self.heading)
+        else: 
+            sys.exit("Unknown groupby: {}".format(self.groupby))
+
+    def fillFeatures(self, utterances, out): 
+        """
+        Write the grouped features into out, a slice of the Conversation's
+        feature buffer sized according to featureLayout. 
+        """
         if self.groupby == "Day": 
-            return self.groupFeaturesByDay(utterances) 
+            self.fillFeaturesByDay(utterances, out)
         elif self.groupby == "Conversation": 
-            return (self.heading, self.features) 
+            out[:] = self.features
         else: 
             sys.exit("Unknown groupby: {}".format(self.groupby))
 
+    def groupFeatures(self, utterances): 
+        headings = self.featureLayout(utterances)
+        features = np.empty(len(headings), dtype=self.dtype)
+        self.fillFeatures(utterances, features)
+        return (headings, features)
+
     def groupFeaturesByDay(self, utterances):        
-        people = set([x.speaker for x in utterances])
-        features = None
-        headings = []
-
-        for person in sorted(people):
-            person_features = {}
-            for utterance, u_features in zip(utterances, self.features):
-                if utterance.speaker != person: continue
-                day = utterance.dt.date()
-                this_features = np.array(u_features)
-                if day not in person_features:
-                    person_features[day] = u_features
-                else:
-                    person_features[day] += np.array(u_features)
-                    
-            if self.normalize: 
+        headings = self.featureLayout(utterances)
+        features = np.empty(len(headings), dtype=self.dtype)
+        self.fillFeaturesByDay(utterances, features)
+        return (headings, features)
+
+    def dailyFeatures(self, utterances): 
+        """
+        Sum the per-utterance features by speaker and day. Returns
+        {speaker: {day: array}}, normalized if self.normalize is set. 
+        """
+        by_person = defaultdict(dict)
+        self.addDaily(by_person, utterances)
+        self.normalizeDaily(by_person)
+        return by_person
+
+    def addDaily(self, by_person, utterances): 
+        for utterance, u_features in zip(utterances, self.features):
+            person_features = by_person[utterance.speaker]
+            day = utterance.dt.date()
+            if day not in person_features:
+                person_features[day] = np.array(u_features, dtype=float)
+            else:
+                person_features[day] += u_features
+
+    def normalizeDaily(self, by_person): 
+        if self.normalize: 
+            for person_features in by_person.values(): 
                 for day, d_features in person_features.items():
-                    d_features[1:] = d_features[1:] / d_features[0]
+                    person_features[day] = self.normalizedDay(d_features)
 
-            this_features = np.vstack(list(person_features.values()))
-            means = this_features.mean(axis=0)
-            variances = this_features.var(axis=0)
+    def normalizedDay(self, d_features): 
+        if self.normalize: 
+            d_features = d_features.copy()
+            d_features[1:] = d_features[1:] / d_features[0]
+        return d_features
 
-            if features is None: 
-                features = np.hstack([means, variances])
+    def fillFeaturesByDay(self, utterances, out): 
+        if utterances is None: 
+            by_person = self.daily
+        else: 
+            by_person = self.dailyFeatures(utterances)
+
+        width = len(self.header())
+        offset = 0
+
+        for person in sorted(by_person):
+            this_features = np.vstack(list(by_person[person].values()))
+            out[offset:offset + width] = this_features.mean(axis=0)
+            out[offset + width:offset + 2 * width] = this_features.var(axis=0)
+            offset += 2 * width
+
+    def windowFeatures(self, conversation, windows): 
+        """
+        Grouped (headings, features) for each (min_threshold, max_threshold)
+        window of conversation, as returned by Conversation.timeWindow. 
+        Expects doFeatures to have already run over the whole conversation. 
+        """
+        if self.groupby == "Day": 
+            return self.windowFeaturesByDay(conversation.utterances, windows)
+
+        results = []
+        for window in windows: 
+            view = conversation.window(*window)
+            if view.utterances: 
+                self.doFeatures(view)
+                results.append(self.groupFeatures(view.utterances))
             else: 
-                features = np.hstack([features, means, variances])
-
-            headings += ["{}_{}_Mean".format(person, feature_name) for feature_name in self.header()]
-            headings += ["{}_{}_Variance".format(person, feature_name) for feature_name in self.header()]
-            
-        return (headings, features)
+                results.append(([], np.empty(0, dtype=self.dtype)))
+        return results
+
+    def windowFeaturesByDay(self, utterances, windows): 
+        """
+        Day-grouped features for several windows from one pass over the
+        utterances, using prefix sums over each speaker's per-day totals. 
+        Windows match Conversation.inWindow, which leaves out messages sent
+        exactly at midnight on a window's first day, so those are summed
+        separately and taken off that day's totals. 
+        """
+        width = len(self.header())
+
+        # speaker -> day -> [sum, count, midnight sum, midnight count]
+        by_person = defaultdict(dict)
+        for utterance, u_features in zip(utterances, self.features):
+            person_days = by_person[utterance.speaker]
+            day = utterance.dt.date()
+            if day not in person_days:
+                person_days[day] = [np.zeros(width), 0, np.zeros(width), 0]
+            totals = person_days[day]
+            totals[0] += u_features
+            totals[1] += 1
+            if utterance.dt.time() == datetime.time():
+                totals[2] += u_features
+                totals[3] += 1
+
+        people = {}
+        for person, person_days in by_person.items(): 
+            days = sorted(person_days)
+            sums = np.vstack([self.normalizedDay(person_days[day][0]) for day in days])
+            zero = np.zeros((1, width))
+            people[person] = (days, [person_days[day] for day in days], sums,
+                              np.vstack([zero, sums.cumsum(axis=0)]),
+                              np.vstack([zero, (sums ** 2).cumsum(axis=0)]))
+
+        results = []
+        for min_threshold, max_threshold in windows: 
+            headings = []
+            features = []
+            for person in sorted(people):
+                days, totals, sums, prefix, prefix_sq = people[person]
+                if min_threshold is None: 
+                    lo, hi = 0, len(days)
+                else: 
+                    lo = bisect_left(days, min_threshold.date())
+                    hi = bisect_left(days, max_threshold.date())
+
+                n = hi - lo
+                total = prefix[hi] - prefix[lo]
+                total_sq = prefix_sq[hi] - prefix_sq[lo]
+
+                if min_threshold is not None and n and days[lo] == min_threshold.date(): 
+                    day_sum, count, midnight_sum, midnight_count = totals[lo]
+                    if midnight_count: 
+                        total = total - sums[lo]
+                        total_sq = total_sq - sums[lo] ** 2
+                        n -= 1
+                        if count > midnight_count: 
+                            rest = self.normalizedDay(day_sum - midnight_sum)
+                            total = total + rest
+                            total_sq = total_sq + rest ** 2
+                            n += 1
+
+                if n == 0: 
+                    continue
+
+                means = total / n
+                variances = np.maximum(total_sq / n - means ** 2, 0)
+
+                headings += ["{}_{}_Mean".format(person, feature_name) for feature_name in self.header()]
+                headings += ["{}_{}_Variance".format(person, feature_name) for feature_name in self.header()]
+                features += [means, variances]
+
+            if features: 
+                results.append((headings, np.hstack(features)))
+            else: 
+                results.append((headings, np.empty(0)))
+        return results
 
 
 
@@ -112,9 +285,14 @@ class CountPOS(FeatureExtractor):
 
         self.tagger_cmd = "java -XX:ParallelGCThreads=2 -Xmx500m -jar lib/ark-tweet-nlp-0.3.2/ark-tweet-nlp-0.3.2.jar"
 
+    def tweets(self, conversation): 
+        return [" ".join(u.lower_tokens) for u in conversation.utterances]
+
     def doFeatures(self, conversation): 
-        tweets = [" ".join(u.lower_tokens) for u in conversation.utterances]
-        parse = runtagger_parse(tweets, self.tagger_cmd)
+        # the pipelined mode tags conversations ahead of time
+        parse = conversation.pos_tags
+        if parse is None: 
+            parse = runtagger_parse(self.tweets(conversation), self.tagger_cmd)
         self.features = [self.doCounts(x) for x in parse]
 
     def doCounts(self, listOfTuples): 
@@ -129,44 +307,46 @@ class ElapsedTime(FeatureExtractor):
         self.normalize = False
 
     def doFeatures(self, conversation):
-        elapsedTimes = defaultdict(list)
-
-        prev_utterance = conversation.utterances[0]
+        self.startChunks()
+        self.doChunk(conversation)
+        self.finishChunks(conversation)
+
+    def startChunks(self): 
+        self.prev_utterance = None
+        # "speaker-speaker" -> [count, min, max, mean, sum of squared deviations]
+        self.elapsedTimes = {}
+
+    def doChunk(self, chunk): 
+        for utterance in chunk.utterances:
+            prev_utterance = self.prev_utterance
+            self.prev_utterance = utterance
+            if prev_utterance is None: 
+                continue
 
-        for utterance in conversation.utterances[1:]:
-            this_speaker = utterance.speaker
-            time_elapsed = utterance.dt - prev_utterance.dt
             if utterance.dt < prev_utterance.dt: 
                 print(utterance.dt, prev_utterance.dt)
-            elapsedTimes["{}-{}".format(prev_utterance.speaker, utterance.speaker)].append(time_elapsed.total_seconds()/60)
-            prev_utterance = utterance
-
+            time_elapsed = (utterance.dt - prev_utterance.dt).total_seconds()/60
+
+            key = "{}-{}".format(prev_utterance.speaker, utterance.speaker)
+            if key not in self.elapsedTimes: 
+                self.elapsedTimes[key] = [0, time_elapsed, time_elapsed, 0.0, 0.0]
+            stats = self.elapsedTimes[key]
+
+            # running mean and variance (Welford), so no list of times is kept
+            stats[0] += 1
+            stats[1] = min(stats[1], time_elapsed)
+            stats[2] = max(stats[2], time_elapsed)
+            delta = time_elapsed - stats[3]
+            stats[3] += delta / stats[0]
+            stats[4] += delta * (time_elapsed - stats[3])
+
+    def finishChunks(self, conversation): 
         self.heading = []
         all_features = []
 
-        for heading, features in sorted(elapsedTimes.items()):
-            # count
-            self.heading.append("{}_Count".format(heading))
-            all_features.append(len(features))
-
-            features = np.array(features)
-
-            # min
-            self.heading.append("{}_Min".format(heading))
-            all_features.append(features.min())
-            
-            # max
-            self.heading.append("{}_Max".format(heading))
-            all_features.append(features.max())
-            
-            # mean
-            self.heading.append("{}_Mean".format(heading))
-            all_features.append(features.mean())
-
-            # variance
-            self.heading.append("{}_Variance".format(heading))
-            all_features.append(features.var())
-        
+        for heading, (count, least, most, mean, m2) in sorted(self.elapsedTimes.items()):
+            self.heading += ["{}_{}".format(heading, x) for x in ["Count", "Min", "Max", "Mean", "Variance"]]
+            all_features += [count, least, most, mean, m2 / count]
 
         self.features = all_features
     
@@ -183,17 +363,21 @@ class ActiveDays(FeatureExtractor):
         self.normalize = False
 
     def doFeatures(self, conversation): 
-        headings = []
-        features = []
-                            
-        people = set([x.speaker for x in conversation.utterances])
-        for person in people:
-            this_days = set([u.dt.date() for u in conversation.utterances if u.speaker == person])
-            headings.append("{}_Days_Active".format(person))
-            features.append(len(this_days))
-
-        self.heading = headings
-        self.features = np.array(features)
+        self.startChunks()
+        self.doChunk(conversation)
+        self.finishChunks(conversation)
+
+    def startChunks(self): 
+        self.days = defaultdict(set)
+
+    def doChunk(self, chunk): 
+        for u in chunk.utterances: 
+            self.days[u.speaker].add(u.dt.date())
+
+    def finishChunks(self, conversation): 
+        people = sorted(self.days)
+        self.heading = ["{}_Days_Active".format(person) for person in people]
+        self.features = np.array([len(self.days[person]) for person in people])
 
 class CSVFeatures(FeatureExtractor): 
     def __init__(self, fname): 
@@ -201,6 +385,10 @@ class CSVFeatures(FeatureExtractor):
         self.groupby = "Conversation"
         self.normalize = False
 
+        # survey answers are passed through as-is, so they may not be numeric
+        self.dtype = object
+        self.windowed = False
+
         self.content = {}
         reader = csv.reader(open(fname, newline=''), delimiter=",", quotechar='"')
 
@@ -223,6 +411,15 @@ class CSVFeatures(FeatureExtractor):
         else:
             self.features = [-1,] * len(self.heading)
 
+    def startChunks(self): 
+        pass
+
+    def doChunk(self, chunk): 
+        pass
+
+    def finishChunks(self, conversation): 
+        self.doFeatures(conversation)
+
 class TimeOfDay(FeatureExtractor): 
     def __init__(self): 
         super().__init__()
@@ -230,20 +427,29 @@ class TimeOfDay(FeatureExtractor):
         self.normalize = False
 
     def doFeatures(self, conversation): 
+        self.startChunks()
+        self.doChunk(conversation)
+        self.finishChunks(conversation)
+
+    def startChunks(self): 
+        self.word_counts = defaultdict(lambda: [0,] * 24)
+        self.text_counts = defaultdict(lambda: [0,] * 24)
+
+    def doChunk(self, chunk): 
+        for u in chunk.utterances: 
+            hour = u.dt.time().hour
+            self.word_counts[u.speaker][hour] += len(u.lower_tokens)
+            self.text_counts[u.speaker][hour] += 1
 
+    def finishChunks(self, conversation): 
         heading = []
         features = []
-                            
-        people = set([x.speaker for x in conversation.utterances])
-        for person in people:
-            per_utters = [(u.dt.time().hour, len(u.lower_tokens)) for u in conversation.utterances if u.speaker == person]
-            word_counts = [sum([words for hour, words in per_utters if hour == i]) for i in range(24)]
-            text_counts = [len([hour for hour, words in per_utters if hour == i]) for i in range(24)]
 
+        for person in sorted(self.word_counts):
             heading += ["{}_Words_Hour_{}".format(person, i) for i in range(24)]
             heading += ["{}_Messages_Hour_{}".format(person, i) for i in range(24)]
 
-            features += word_counts + text_counts
+            features += self.word_counts[person] + self.text_counts[person]
 
         self.heading = heading
         self.features = np.array(features)
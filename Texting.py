@@ -1,6 +1,6 @@
 import sys
 import re
-from collections import defaultdict
+from collections import defaultdict, deque
 from emoticons import analyze_tweet as emoticons
 import unicodedata
 from twokenize_wrapper import tokenize
@@ -88,12 +88,15 @@ class Utterance():
         self.lower_tokens, self.body = self.cleanHelper(self.body)
 
 class Conversation():
-    def __init__(self, fname=None, norm=None): 
+    def __init__(self, fname=None, norm=None, chunksize=None): 
         self.utterances = []
         self.annotators = []
         self.normalizer = norm
         self.fname = fname
-        if fname is not None: 
+        self.pos_tags = None
+        self.chunksize = chunksize
+        self.last_dt = None
+        if fname is not None and chunksize is None: 
             self.loadFile(fname)
 
     def participantName(self): 
@@ -107,6 +110,85 @@ class Conversation():
             self.addUtterance(name, dt, body)
         self.utterances = [x for x in self.utterances if x.lower_tokens]
 
+    def streamFile(self, fname): 
+        """
+        Yield the non-empty Utterances of fname one at a time instead of
+        keeping them all in memory. 
+        """
+        reader = csv.reader(open(fname, newline=''), delimiter="\t", quotechar='"')
+
+        for row in reader: 
+            name, dt, body = row
+            utterance = Utterance(name, dt, body, norm=self.normalizer)
+            if utterance.lower_tokens: 
+                yield utterance
+
+    def findLastUtterance(self, fname): 
+        """
+        Time of the last non-empty utterance in fname, found without
+        cleaning every line: only the trailing chunksize lines are kept and
+        cleaned, from the end. 
+        """
+        reader = csv.reader(open(fname, newline=''), delimiter="\t", quotechar='"')
+        tail = deque(reader, maxlen=self.chunksize)
+
+        for name, dt, body in reversed(tail): 
+            utterance = Utterance(name, dt, body, norm=self.normalizer)
+            if utterance.lower_tokens: 
+                return utterance.dt
+
+        # everything near the end cleaned away; look through the whole file
+        last_dt = None
+        for utterance in self.streamFile(fname): 
+            last_dt = utterance.dt
+        return last_dt
+
+    def processChunks(self, annotators, numDays): 
+        """
+        Annotate the conversation chunksize utterances at a time. Each
+        annotator reduces every chunk into per-day/per-speaker aggregates,
+        so memory grows with the number of days and speakers rather than
+        the number of messages. Afterwards utterances is None and
+        groupFeatures works from the aggregates. Returns the number of
+        utterances processed. 
+        """
+        self.annotators = list(annotators)
+        self.utterances = None
+
+        min_threshold = None
+        if numDays > 0: 
+            self.last_dt = self.findLastUtterance(self.fname)
+            if self.last_dt is None: 
+                return 0
+            min_threshold, max_threshold = self.timeWindow(numDays)
+
+        for annotator in self.annotators: 
+            annotator.startChunks()
+
+        count = 0
+        chunk = []
+        for utterance in self.streamFile(self.fname): 
+            if min_threshold is not None and not (utterance.dt > min_threshold and utterance.dt < max_threshold): 
+                continue
+            chunk.append(utterance)
+            if len(chunk) == self.chunksize: 
+                self.doChunk(chunk)
+                count += len(chunk)
+                chunk = []
+        if chunk: 
+            self.doChunk(chunk)
+            count += len(chunk)
+
+        for annotator in self.annotators: 
+            annotator.finishChunks(self)
+
+        return count
+
+    def doChunk(self, utterances): 
+        chunk = self.subset(utterances)
+        for annotator in self.annotators: 
+            annotator.doChunk(chunk)
+
     def addAnnotator(self, annotator): 
         self.annotators.append(annotator)
         annotator.doFeatures(self)
@@ -115,32 +197,106 @@ class Conversation():
         self.utterances.append(Utterance(name, dt, body, norm=self.normalizer))
 
     def lastUtterance(self): 
+        if self.utterances is None: 
+            return self.last_dt
         return self.utterances[-1].dt
-    def limitTimeRange(self, numDays): 
+    def timeWindow(self, numDays): 
+        """
+        (min_threshold, max_threshold) covering the numDays whole days before
+        the last day of the conversation, or (None, None) for numDays <= 0. 
+        """
         if numDays > 0:
             max_threshold = datetime.datetime.combine(self.lastUtterance().date(), datetime.time())
             min_threshold = max_threshold - datetime.timedelta(days=numDays)
+            return min_threshold, max_threshold
+        return None, None
+
+    def inWindow(self, min_threshold, max_threshold): 
+        if min_threshold is None: 
+            return list(self.utterances)
+        return [x for x in self.utterances if x.dt > min_threshold and x.dt < max_threshold]
 
-            self.utterances = [x for x in self.utterances if x.dt > min_threshold and x.dt < max_threshold]
+    def limitTimeRange(self, numDays): 
+        if numDays > 0:
+            self.utterances = self.inWindow(*self.timeWindow(numDays))
+
+    def window(self, min_threshold, max_threshold): 
+        """
+        A Conversation over the same file holding only the utterances
+        inside the window. Utterances are shared, not re-parsed. 
+        """
+        return self.subset(self.inWindow(min_threshold, max_threshold))
+
+    def subset(self, utterances): 
+        view = Conversation(norm=self.normalizer)
+        view.fname = self.fname
+        view.utterances = utterances
+        return view
     def uniqueTokens(self): 
         tokens = Counter()
         for utterance in self.utterances: 
             tokens.update(utterance.uniqueTokens())
         return tokens
 
-    def groupFeatures(self):
-        self.features = None
-        self.heading = ["Conversation", ]
+    def featureLayout(self): 
+        """
+        Plan the output columns before any features are computed. Returns
+        the full heading and a (annotator, start, stop) slice of the feature
+        vector for each annotator. 
+        """
+        heading = ["Conversation", ]
+        slices = []
 
         for annotator in self.annotators: 
-            this_heading, this_features = annotator.groupFeatures(self.utterances)
+            this_heading = annotator.featureLayout(self.utterances)
+            start = len(heading) - 1
+            slices.append((annotator, start, start + len(this_heading)))
+            heading += this_heading
+
+        return heading, slices
+
+    def featureType(self): 
+        if any(annotator.dtype is object for annotator in self.annotators): 
+            return object
+        return float
+
+    def groupFeatures(self):
+        self.heading, slices = self.featureLayout()
+        self.features = np.empty(len(self.heading) - 1, dtype=self.featureType())
+
+        for annotator, start, stop in slices: 
+            annotator.fillFeatures(self.utterances, self.features[start:stop])
+
+    def groupWindowFeatures(self, horizons): 
+        """
+        Like groupFeatures, but for several time windows at once (see
+        timeWindow). Columns for each horizon are suffixed with e.g. "_14d",
+        or "_All" for a horizon of 0, and appear in the order given, after
+        the unsuffixed columns of annotators that do not depend on time. 
+        """
+        if any(numDays < 0 for numDays in horizons): 
+            sys.exit("Time windows must be 0 or more days: {}".format(horizons))
+        horizons = list(dict.fromkeys(horizons))
+
+        windows = [self.timeWindow(numDays) for numDays in horizons]
+        parts = [annotator.groupFeatures(self.utterances) for annotator in self.annotators if not annotator.windowed]
+        results = [annotator.windowFeatures(self, windows) for annotator in self.annotators if annotator.windowed]
+
+        for i, numDays in enumerate(horizons): 
+            label = "{}d".format(numDays) if numDays > 0 else "All"
+            for annotator_results in results: 
+                this_heading, this_features = annotator_results[i]
+                parts.append((["{}_{}".format(x, label) for x in this_heading], this_features))
 
+        self.heading = ["Conversation", ]
+        for this_heading, this_features in parts: 
             self.heading += this_heading
 
-            if self.features is None: 
-                self.features = this_features
-            else: 
-                self.features = np.hstack([self.features, this_features])
+        self.features = np.empty(len(self.heading) - 1, dtype=self.featureType())
+        start = 0
+        for this_heading, this_features in parts: 
+            self.features[start:start + len(this_heading)] = this_features
+            start += len(this_heading)
 
     def writeFeatures(self, fname, need_header, conversation_name):
         writer = csv.writer(open(fname, newline='', mode='a'), delimiter=",", quotechar='"')
@@ -161,6 +317,43 @@ class Conversation():
             text_counts = [len([hour for hour, words in per_utters if hour == i]) for i in range(24)]
             writer.writerow([self.fname, person,] + word_counts + text_counts)
 
+def stackFeatures(rows): 
+    """
+    Combine grouped features of several conversations into a single
+    (n_conversations x n_features) matrix. rows holds a (heading, features)
+    pair per conversation, as left on a Conversation by groupFeatures. 
+    Conversations whose headings differ (e.g. different speaker names) are
+    aligned by column name, and missing columns are left as NaN. 
+    """
+    heading = ["Conversation", ]
+    columns = {}
+    for this_heading, this_features in rows: 
+        for name in this_heading[1:]: 
+            if name not in columns: 
+                columns[name] = len(heading) - 1
+                heading.append(name)
+
+    if any(this_features.dtype == object for this_heading, this_features in rows): 
+        dtype = object
+    else: 
+        dtype = float
+
+    matrix = np.full((len(rows), len(heading) - 1), np.nan, dtype=dtype)
+    for row, (this_heading, this_features) in zip(matrix, rows): 
+        if this_heading == heading: 
+            row[:] = this_features
+        else: 
+            index = [columns[name] for name in this_heading[1:]]
+            row[index] = this_features
+
+    return heading, matrix
+
+def writeFeatureMatrix(fname, heading, names, matrix): 
+    writer = csv.writer(open(fname, newline='', mode='w'), delimiter=",", quotechar='"')
+    writer.writerow(heading)
+    for name, row in zip(names, matrix): 
+        writer.writerow([name,] + list(row))
+
 class Dictionary(): 
     def __init__(self, fname): 
         self.categories = {}
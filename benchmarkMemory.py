@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import random
+import datetime
+import resource
+import argparse
+import subprocess
+import tempfile
+from Texting import Conversation, Normalizer
+from FeatureExtractors import CountWords, ActiveDays, ElapsedTime, TimeOfDay
+
+"""
+Measures peak memory of feature extraction on synthetic conversations of
+increasing length, with and without --chunksize. Every conversation spans
+the same number of days between the same two speakers, so with chunking
+peak RSS should stay flat as the number of messages grows.
+
+Each measurement runs in its own process so peak RSS is not shared.
+"""
+
+WORDS = ["hey", "what", "are", "you", "doing", "tonight", "dinner", "sounds",
+         "good", "see", "soon", "lol", "ok", "running", "late", "tomorrow"]
+
+def writeConversation(fname, num_messages, num_days):
+    start = datetime.datetime(2015, 1, 1)
+    step = datetime.timedelta(days=num_days) / num_messages
+    rng = random.Random(num_messages)
+
+    with open(fname, "w") as out:
+        for i in range(num_messages):
+            dt = start + step * i
+            body = " ".join(rng.choice(WORDS) for x in range(rng.randint(1, 12)))
+            out.write("{}\t{}\t{}\n".format(rng.choice(["A", "B"]), dt.strftime("%m/%d/%Y %H:%M"), body))
+
+def measure(fname, chunksize):
+    annotators = [CountWords(), ActiveDays(), ElapsedTime(), TimeOfDay()]
+
+    if chunksize:
+        conversation = Conversation(fname, norm=Normalizer(), chunksize=chunksize)
+        conversation.processChunks(annotators, 0)
+    else:
+        conversation = Conversation(fname, norm=Normalizer())
+        for annotator in annotators:
+            conversation.addAnnotator(annotator)
+    conversation.groupFeatures()
+
+    # kilobytes on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        maxrss /= 1024
+    print(int(maxrss / 1024))
+
+def main(args):
+    print("Messages,Chunksize,Peak RSS (MB)")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in args.sizes:
+            fname = os.path.join(tmpdir, "conversation_{}.csv".format(size))
+            writeConversation(fname, size, args.days)
+
+            for chunksize in [0, args.chunksize]:
+                result = subprocess.run([sys.executable, __file__, "--measure", fname, "--chunksize", str(chunksize)],
+                                        stdout=subprocess.PIPE, check=True, universal_newlines=True)
+                print("{},{},{}".format(size, chunksize or "-", result.stdout.strip()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare peak memory with and without chunked processing.')
+    parser.add_argument('--sizes', metavar='N', type=int, nargs='+', help='numbers of messages to test', default=[10000, 50000, 200000])
+    parser.add_argument('--days', metavar='N', type=int, help='number of days each conversation spans', default=365)
+    parser.add_argument('--chunksize', metavar='N', type=int, default=5000)
+    parser.add_argument('--measure', metavar='FILE.csv', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure, args.chunksize)
+    else:
+        main(args)
@@ -5,8 +5,9 @@ import sys
 import re
 import os
 import argparse
-from Texting import Dictionary, Conversation, Utterance, Normalizer
+from Texting import Dictionary, Conversation, Utterance, Normalizer, stackFeatures, writeFeatureMatrix
 from FeatureExtractors import *
+from pipeline import runPipeline, FakeTagger
 
 """
 Load a conversation and one or more Annotators, then process each line
@@ -36,23 +37,58 @@ def main(args):
     if args.timeofday or args.allfeatures: 
         annotators.append(TimeOfDay())
 
+    if args.pipeline: 
+        tagger = FakeTagger() if args.faketagger else None
+        runPipeline(args.textfiles, args.time, thisNorm, annotators, args.out, tagger=tagger, taggers=args.taggers, horizons=args.times)
+        return
+
+    if args.batch: 
+        # keep only the feature vectors, so each Conversation can be freed
+        names = []
+        rows = []
+        for csvFile in args.textfiles: 
+            conversation = processFile(csvFile, args.time, thisNorm, annotators, False, write=False, horizons=args.times, chunksize=args.chunksize)
+            if conversation is not None: 
+                names.append(os.path.splitext(os.path.basename(csvFile))[0])
+                rows.append((conversation.heading, conversation.features))
+            del conversation
+
+        heading, matrix = stackFeatures(rows)
+        writeFeatureMatrix(args.out, heading, names, matrix)
+        return
+
     need_header = True
     for csvFile in args.textfiles: 
-        processFile(csvFile, args.time, thisNorm, annotators, need_header)
+        processFile(csvFile, args.time, thisNorm, annotators, need_header, horizons=args.times, chunksize=args.chunksize)
         need_header = False
 
-def processFile(fname, numDays, thisNorm, annotators, need_header):
+def processFile(fname, numDays, thisNorm, annotators, need_header, write=True, horizons=None, chunksize=None):
+
+    if chunksize: 
+        conversation = Conversation(fname, norm=thisNorm, chunksize=chunksize)
+        if annotators and conversation.processChunks(annotators, numDays): 
+            conversation.groupFeatures()
+            if write: 
+                conversation.writeFeatures(args.out, need_header, os.path.basename(fname))
+            return conversation
+        return
 
     conversation = Conversation(fname, norm=thisNorm)
-    conversation.limitTimeRange(numDays)
+    if not horizons: 
+        conversation.limitTimeRange(numDays)
 
     if annotators and conversation.utterances:
         for annotator in annotators:
             conversation.addAnnotator(annotator)
 
-        conversation.groupFeatures()
-            
-        conversation.writeFeatures(args.out, need_header, os.path.basename(fname))
+        if horizons: 
+            conversation.groupWindowFeatures(horizons)
+        else: 
+            conversation.groupFeatures()
+
+        if write: 
+            conversation.writeFeatures(args.out, need_header, os.path.basename(fname))
+        return conversation
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Extract features from text data files.')
@@ -63,6 +99,7 @@ if __name__ == "__main__":
     parser.add_argument('--out', '-o', metavar='FILE', help='Write results to FILE in .csv format', default="all_features.csv")
     parser.add_argument('--norm', '-n', metavar='NORM.dic', help='a tab-delimited set of replacements')
     parser.add_argument('--time', '-t', metavar='N', type=int, help='number of days to process', default=14)
+    parser.add_argument('--times', metavar='N', type=int, nargs='+', help='compute features for each of several numbers of days (0 for all) instead of --time')
     parser.add_argument('--countwords', '-w', action='store_true')
     parser.add_argument('--countpos', '-p', action='store_true')
     parser.add_argument('--responsetimes', '-r', action='store_true')
@@ -70,8 +107,20 @@ if __name__ == "__main__":
     parser.add_argument('--timeofday', action='store_true')
     parser.add_argument('--activedays', action='store_true')
     parser.add_argument('--allfeatures', action='store_true')
+    parser.add_argument('--batch', action='store_true', help='write all conversations as one aligned feature matrix')
+    parser.add_argument('--pipeline', action='store_true', help='overlap loading, POS tagging and feature extraction across files')
+    parser.add_argument('--taggers', metavar='N', type=int, help='number of concurrent tagger processes in --pipeline mode', default=1)
+    parser.add_argument('--faketagger', action='store_true', help='tag every token as NN instead of running the POS tagger')
+    parser.add_argument('--chunksize', metavar='N', type=int, help='process each conversation N utterances at a time to bound memory use')
     args = parser.parse_args()
 
+    if args.chunksize and (args.pipeline or args.times): 
+        parser.error("--chunksize cannot be combined with --pipeline or --times")
+    if args.times and any(numDays < 0 for numDays in args.times): 
+        parser.error("--times values must be 0 (all days) or more")
+    if args.pipeline and args.batch: 
+        parser.error("--pipeline cannot be combined with --batch")
+
     main(args)
 
 
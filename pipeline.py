@@ -0,0 +1,161 @@
+import asyncio
+import os
+import sys
+import shlex
+from Texting import Conversation
+from FeatureExtractors import CountPOS
+
+"""
+Pipelined version of extract.processFile. Loading and cleaning, POS
+tagging and feature aggregation/writing run as separate asyncio stages
+connected by bounded queues, so the tagger subprocess for one conversation
+runs while the next one is being tokenized. Output rows are written in the
+same order as the input files.
+"""
+
+class SubprocessTagger():
+    """
+    Runs the ark-tweet-nlp tagger as an asyncio subprocess. Produces the
+    same [(word, tag, confidence), ...] lists as CMUTweetTagger.runtagger_parse.
+    """
+    def __init__(self, cmd):
+        self.cmd = cmd
+
+    async def tag(self, tweets):
+        message = "\n".join([tw.replace("\n", " ") for tw in tweets])
+        args = shlex.split(self.cmd) + ["--output-format", "conll"]
+
+        proc = await asyncio.create_subprocess_exec(*args,
+                                                    stdin=asyncio.subprocess.PIPE,
+                                                    stdout=asyncio.subprocess.PIPE)
+        stdout, stderr = await proc.communicate(message.encode("utf-8"))
+
+        parse = []
+        for block in stdout.decode("utf-8").strip("\n").split("\n\n"):
+            rows = [line.strip().split("\t") for line in block.split("\n")]
+            parse.append([(word, tag, float(confidence)) for word, tag, confidence in
+                          [row for row in rows if len(row) == 3]])
+        return parse
+
+class FakeTagger():
+    """
+    Stand-in for SubprocessTagger that needs no Java or tagger jar. Tags
+    every token as NN, optionally after a delay to imitate the subprocess.
+    """
+    def __init__(self, tag="NN", delay=0):
+        self.fixed_tag = tag
+        self.delay = delay
+
+    async def tag(self, tweets):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return [[(word, self.fixed_tag, 1.0) for word in tw.split()] for tw in tweets]
+
+
+class PipelineError(Exception):
+    """A stage called sys.exit; carries its message out of the worker thread."""
+    pass
+
+def exitToError(func, *args):
+    try:
+        return func(*args)
+    except SystemExit as e:
+        raise PipelineError(e.code)
+
+async def inThread(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, exitToError, func, *args)
+
+def runPipeline(fnames, numDays, thisNorm, annotators, out, tagger=None, taggers=1, queue_size=4, horizons=None):
+    try:
+        asyncio.run(pipeline(fnames, numDays, thisNorm, annotators, out, tagger, taggers, queue_size, horizons))
+    except PipelineError as e:
+        sys.exit(str(e))
+
+async def pipeline(fnames, numDays, thisNorm, annotators, out, tagger=None, taggers=1, queue_size=4, horizons=None):
+    pos_annotators = [x for x in annotators if isinstance(x, CountPOS)]
+    pos_annotator = pos_annotators[0] if pos_annotators else None
+    if pos_annotator is not None and tagger is None:
+        tagger = SubprocessTagger(pos_annotator.tagger_cmd)
+
+    loaded = asyncio.Queue(maxsize=queue_size)
+    tagged = asyncio.Queue(maxsize=queue_size)
+
+    if horizons:
+        # windows are cut after tagging, from the full conversation
+        numDays = 0
+
+    loader = asyncio.ensure_future(loadStage(fnames, numDays, thisNorm, loaded, taggers))
+    tag_workers = [asyncio.ensure_future(tagStage(tagger, pos_annotator, loaded, tagged)) for i in range(taggers)]
+    writer = asyncio.ensure_future(writeStage(annotators, tagged, out, taggers, horizons))
+
+    stages = [loader, writer] + tag_workers
+    try:
+        await asyncio.gather(*stages)
+    except BaseException:
+        # stop the other stages rather than leave them blocked on a queue
+        for stage in stages:
+            stage.cancel()
+        await asyncio.gather(*stages, return_exceptions=True)
+        raise
+
+def loadConversation(fname, numDays, thisNorm):
+    conversation = Conversation(fname, norm=thisNorm)
+    conversation.limitTimeRange(numDays)
+    return conversation
+
+async def loadStage(fnames, numDays, thisNorm, loaded, taggers):
+    for index, fname in enumerate(fnames):
+        conversation = await inThread(loadConversation, fname, numDays, thisNorm)
+        await loaded.put((index, conversation))
+
+    # one sentinel per tagging worker
+    for i in range(taggers):
+        await loaded.put(None)
+
+async def tagStage(tagger, pos_annotator, loaded, tagged):
+    while True:
+        item = await loaded.get()
+        if item is None:
+            await tagged.put(None)
+            return
+
+        index, conversation = item
+        if pos_annotator is not None and conversation.utterances:
+            conversation.pos_tags = await tagger.tag(pos_annotator.tweets(conversation))
+        await tagged.put((index, conversation))
+
+def aggregate(conversation, annotators, out, need_header, horizons=None):
+    for annotator in annotators:
+        conversation.addAnnotator(annotator)
+    if horizons:
+        conversation.groupWindowFeatures(horizons)
+    else:
+        conversation.groupFeatures()
+    conversation.writeFeatures(out, need_header, os.path.basename(conversation.fname))
+
+async def writeStage(annotators, tagged, out, taggers, horizons=None):
+    # several tagging workers may finish out of order; hold results until
+    # every earlier file has been written
+    pending = {}
+    next_index = 0
+    finished = 0
+    need_header = True
+
+    while finished < taggers:
+        item = await tagged.get()
+        if item is None:
+            finished += 1
+            continue
+
+        index, conversation = item
+        pending[index] = conversation
+
+        while next_index in pending:
+            conversation = pending.pop(next_index)
+            next_index += 1
+
+            if annotators and conversation.utterances:
+                # annotators are shared, so aggregation stays sequential
+                await inThread(aggregate, conversation, annotators, out, need_header, horizons)
+                need_header = False